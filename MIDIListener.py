@@ -1,72 +1,190 @@
 import mido
+import rtmidi
+import numpy as np
 import time
 import os
 import threading
+import array
+import collections
 import tkinter as tk
 from tkinter.scrolledtext import ScrolledText
 import sys
+import signal
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 if sys.platform == 'win32':
     import ctypes
     ctypes.windll.user32.ShowWindow(ctypes.windll.kernel32.GetConsoleWindow(), 0)
 
 MIDI_PORT_NAME = None
+VERBOSE = False  # log every incoming MIDI message
 OUTPUT_DIR = "midi_captures"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+FILENAME_TEMPLATE = os.path.join(OUTPUT_DIR, "capture_{}.mid")
 
-NO_INPUT_TIMEOUT = 5 * 60
+NO_INPUT_TIMEOUT = 5 * 60 * 1_000_000_000  # nanoseconds
 MIN_NOTES = 10
+TICKS_PER_BEAT = 480
+TEMPO = 600_000  # microseconds per beat used to convert timestamps to ticks
+TICKS_PER_NS = TICKS_PER_BEAT / TEMPO / 1000
+FORCE_SAVE_NOTE = 36  # C2, press 3 times in a row to save and show the log
 RECONNECT_INTERVAL = 2  # seconds between reconnection attempts
+DRAIN_INTERVAL_MS = 50  # milliseconds between processing queued MIDI input
+PORT_CHECK_INTERVAL_MS = 1000  # milliseconds between device availability checks
+PORT_MISSES_BEFORE_DISCONNECT = 3  # consecutive failed checks before reconnecting
+PENDING_CAPACITY = 4096  # messages queued between drains (power of 2)
+MAX_BUFFERED_EVENTS = 200_000  # capture is saved early beyond this (~2h of dense playing)
+LOG_HISTORY = 2000  # log lines kept for the log window
+LOG_INSERT_CHUNK = 200  # lines inserted into the log window between redraws
+
+NOTE_ON = 0x90
+REALTIME_MIN_STATUS = 0xF8
+
+class EventRing:
+    """Pre-allocated single-producer/single-consumer queue of timestamped messages.
+
+    The MIDI thread only writes slots and advances tail, the Tk thread only
+    reads slots and advances head, so neither side locks or allocates. If the
+    consumer falls a full ring behind, the oldest messages are dropped.
+    """
+
+    def __init__(self, capacity):
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of 2")
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.msgs = [None] * capacity
+        self.times = array.array('q', [0]) * capacity
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+
+    def push(self, msg, timestamp):
+        i = self.tail & self.mask
+        self.msgs[i] = msg
+        self.times[i] = timestamp
+        # Publish only after the slot is filled
+        self.tail += 1
+
+    def pop_all(self):
+        """Yield every queued (msg, timestamp) pair in arrival order"""
+        head = self.head
+        tail = self.tail
+        if tail - head > self.capacity:
+            self.dropped += tail - head - self.capacity
+            head = tail - self.capacity
+        while head != tail:
+            i = head & self.mask
+            # The producer writes this slot again once tail reaches
+            # head + capacity, so it must not get there before or during
+            # the read
+            if self.tail - head >= self.capacity:
+                msg = None
+            else:
+                msg = self.msgs[i]
+                timestamp = self.times[i]
+                if self.tail - head >= self.capacity:
+                    msg = None
+            head += 1
+            self.head = head
+            if msg is None:
+                self.dropped += 1
+                continue
+            yield msg, timestamp
 
 class MidiRecorder:
     def __init__(self):
-        self.buffer = []
-        self.last_input_time = time.time()
+        # Captured messages and their int64 nanosecond timestamps, side by side
+        self.buffer_msgs = []
+        self.buffer_times = array.array('q')
+        self.pending = EventRing(PENDING_CAPACITY)
+        self.last_input_time = time.perf_counter_ns()
         self.note_on_count = 0
-        self.log_output = []
+        self.force_save_presses = 0
+        self.log_output = collections.deque(maxlen=LOG_HISTORY)
+        self.log_listeners = []
+        self.log_unflushed = collections.deque()
+        # Lets a new log window copy the history and subscribe in one step
+        self.log_lock = threading.Lock()
         self.gui_open = False
         self.connected_port_name = None
+        self.port = None
+        self.port_probe = None
+        self.port_names = []
+        self.port_misses = 0
+        self.waiting_for_device = False
+        self.last_save_stamp = None
+        self.stop_event = threading.Event()
+        self.shut_down = False
+        # Single worker so captures are written in order, off the Tk thread
+        self.save_pool = ThreadPoolExecutor(max_workers=1)
 
         self.root = tk.Tk()
         self.root.withdraw()
+        self.root.report_callback_exception = self.report_callback_exception
 
     def log(self, text):
         print(text)
-        self.log_output.append(text)
+        with self.log_lock:
+            self.log_output.append(text)
+            # Batch lines so a burst of logging repaints the window once. This
+            # may run on the save worker, so only queue here and let the drain
+            # flush from the Tk thread
+            if self.log_listeners:
+                self.log_unflushed.append(text)
+
+    def _flush_log(self):
+        """Pass lines logged since the last flush to open log windows"""
+        lines = []
+        while self.log_unflushed:
+            lines.append(self.log_unflushed.popleft())
+        if lines:
+            for listener in self.log_listeners:
+                listener(lines)
+
+    def report_callback_exception(self, exc, val, tb):
+        """Log errors raised inside Tk callbacks instead of losing them"""
+        if issubclass(exc, KeyboardInterrupt):
+            # Let Ctrl+C leave mainloop instead of being reported
+            raise val
+        self.log("".join(traceback.format_exception(exc, val, tb)).rstrip())
+
+    def refresh_port_names(self):
+        """Enumerate MIDI inputs once and cache the result"""
+        # Created on first use so a MIDI backend that isn't up yet at boot
+        # is retried by connect() instead of stopping the recorder
+        if self.port_probe is None:
+            self.port_probe = rtmidi.MidiIn()
+        self.port_names = self.port_probe.get_ports()
 
     def find_midi_input(self):
-        """Find and return the first available MIDI input port"""
+        """Find and return the first available MIDI input port from the cache"""
         if MIDI_PORT_NAME:
-            inputs = mido.get_input_names()
-            if MIDI_PORT_NAME in inputs:
+            if MIDI_PORT_NAME in self.port_names:
                 return MIDI_PORT_NAME
             else:
                 return None
         else:
-            inputs = mido.get_input_names()
-            return inputs[0] if inputs else None
-
-    def wait_for_midi_connection(self):
-        """Wait for a MIDI device to connect"""
-        self.log("Waiting for MIDI device to connect...")
-        while True:
-            port_name = self.find_midi_input()
-            if port_name:
-                self.log(f"MIDI device found: {port_name}")
-                return port_name
-            time.sleep(RECONNECT_INTERVAL)
-
-    def open_midi_input(self):
+            return self.port_names[0] if self.port_names else None
+
+    def _on_msg(self, event, data):
+        """Queue an incoming message's raw bytes; runs on the RtMidi thread"""
+        self.pending.push(bytes(event[0]), time.perf_counter_ns())
+
+    def open_midi_input(self, port_name):
         """Open MIDI input with error handling"""
-        port_name = self.find_midi_input()
-        if not port_name:
-            port_name = self.wait_for_midi_connection()
-        
         try:
             self.connected_port_name = port_name
             self.log(f"Connecting to MIDI input: {port_name}")
-            return mido.open_input(port_name)
-        except Exception as e:
+            midi_in = rtmidi.MidiIn()
+            port_index = midi_in.get_ports().index(port_name)
+            # Same filtering as mido's backend: keep sysex and timing
+            midi_in.ignore_types(sysex=False, timing=False, active_sense=True)
+            midi_in.set_callback(self._on_msg)
+            midi_in.open_port(port_index)
+            return midi_in
+        except (rtmidi.RtMidiError, ValueError) as e:
             self.log(f"Failed to open MIDI port {port_name}: {e}")
             raise
 
@@ -74,55 +192,89 @@ class MidiRecorder:
         """Check if the currently connected port is still available"""
         if not self.connected_port_name:
             return False
-        
-        available_ports = mido.get_input_names()
-        return self.connected_port_name in available_ports
+        if self.port is None:
+            return False
+
+        return self.connected_port_name in self.port_names
+
+    def _reset_buffer(self):
+        self.buffer_msgs = []
+        self.buffer_times = array.array('q')
+        self.note_on_count = 0
 
     def save_buffer_to_file(self, force=False):
-        if self.note_on_count < MIN_NOTES and not force:
+        # A forced save still needs more than the three trigger presses
+        if (not force and self.note_on_count < MIN_NOTES) or self.note_on_count <= 3:
             self.log(f"Discarding file (only {self.note_on_count} notes).")
-            self.buffer.clear()
-            self.note_on_count = 0
+            self._reset_buffer()
             return
 
-        if self.note_on_count <= 3:
-            self.log(f"Discarding file (no notes pressed)")
-            self.buffer.clear()
-            self.note_on_count = 0
-            return
+        # Hand the capture to the save worker and start a fresh buffer
+        msgs, times = self.buffer_msgs, self.buffer_times
+        note_count = self.note_on_count
+        self._reset_buffer()
 
-        mid = mido.MidiFile()
-        track = mido.MidiTrack()
-        mid.tracks.append(track)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        if stamp == self.last_save_stamp:
+            # Two saves in the same second would overwrite each other
+            filename = FILENAME_TEMPLATE.format(f"{stamp}-{time.perf_counter_ns() & 0xFFFF:04x}")
+        else:
+            filename = FILENAME_TEMPLATE.format(stamp)
+        self.last_save_stamp = stamp
+        self.save_pool.submit(self._write_midi_file, msgs, times, note_count, filename)
 
-        first_time = self.buffer[0][1] if self.buffer else 0
-        last_time = first_time
-        
-        for msg, abs_time in self.buffer:
-            delta_seconds = abs_time - last_time
+    def _write_midi_file(self, msgs, times, note_count, filename):
+        """Assemble and write a capture; runs on the save worker thread"""
+        try:
+            mid = mido.MidiFile(ticks_per_beat=TICKS_PER_BEAT)
+            track = mido.MidiTrack()
+            mid.tracks.append(track)
 
-            delta_ticks = mido.second2tick(delta_seconds, mid.ticks_per_beat, 600000)
+            # Convert all timestamps to ticks in one pass; converting absolute
+            # times rather than each delta keeps long captures from drifting
+            times = np.frombuffer(times, dtype=np.int64)
+            ticks = ((times - times[0]) * TICKS_PER_NS).astype(np.int64)
+            delta_ticks = np.diff(ticks, prepend=0)
 
-            new_msg = msg.copy(time=int(delta_ticks))
-            track.append(new_msg)
-            
-            last_time = abs_time
+            # Messages are only parsed here, once per capture
+            carry = 0
+            for raw, delta in zip(msgs, delta_ticks.tolist()):
+                try:
+                    track.append(mido.Message.from_bytes(raw, time=carry + delta))
+                except ValueError:
+                    # Skip what mido can't parse but keep the timing after it
+                    carry += delta
+                    continue
+                carry = 0
 
-        timestamp = time.strftime("%Y%m%d-%H%M%S")
-        filename = os.path.join(OUTPUT_DIR, f"capture_{timestamp}.mid")
-        mid.save(filename)
-        self.log(f"Saved {filename} with {self.note_on_count} notes.")
+            mid.save(filename)
+        except Exception as e:
+            self.log(f"Failed to save {filename}: {e}")
+            return
 
-        self.buffer.clear()
-        self.note_on_count = 0
+        self.log(f"Saved {filename} with {note_count} notes.")
 
     def show_log_window(self):
         if self.gui_open:
             return
         self.gui_open = True
 
+        def append_lines(lines):
+            if not text_area.winfo_exists():
+                return
+            text_area.configure(state='normal')
+            text_area.insert(tk.END, "\n".join(lines) + "\n")
+            # Keep the widget as bounded as the log history itself
+            excess = int(text_area.index('end-1c').split('.')[0]) - 1 - LOG_HISTORY
+            if excess > 0:
+                text_area.delete("1.0", f"{excess + 1}.0")
+            text_area.configure(state='disabled')
+            text_area.see(tk.END)
+
         def on_close():
             self.gui_open = False
+            with self.log_lock:
+                self.log_listeners.remove(append_lines)
             window.destroy()
 
         window = tk.Toplevel(self.root)
@@ -137,86 +289,188 @@ class MidiRecorder:
 
         text_area = ScrolledText(window, state='normal')
         text_area.pack(fill='both', expand=True)
-        text_area.insert(tk.END, "\n".join(self.log_output))
+        # Copy the history and start streaming new lines together, so a line
+        # the save worker logs meanwhile lands in exactly one of them
+        with self.log_lock:
+            history = list(self.log_output)
+            self.log_listeners.append(append_lines)
+
+        # Fill in chunks so a long history doesn't freeze the window
+        for i, line in enumerate(history, 1):
+            text_area.insert(tk.END, line + "\n")
+            if i % LOG_INSERT_CHUNK == 0:
+                text_area.update_idletasks()
         text_area.configure(state='disabled')
+        text_area.see(tk.END)
 
         window.protocol("WM_DELETE_WINDOW", on_close)
 
+        # Modeless: the window shares the main event loop with MIDI intake
         window.focus_force()
-        window.grab_set()
-        window.wait_window()
+
+    def _process_pending(self):
+        """Move queued MIDI messages into the capture buffer"""
+        pending = self.pending
+        if pending.head == pending.tail:
+            return
+
+        # Bound methods and a local timestamp keep attribute lookups out
+        # of the per-event path; saving swaps the buffers, so rebind after
+        append_msg = self.buffer_msgs.append
+        append_time = self.buffer_times.append
+        last_input_time = None
+        for msg, now in pending.pop_all():
+            status = msg[0]
+            if status >= REALTIME_MIN_STATUS:
+                continue
+            append_msg(msg)
+            append_time(now)
+            last_input_time = now
+            if status & 0xF0 == NOTE_ON and msg[2]:
+                self.note_on_count += 1
+                if msg[1] == FORCE_SAVE_NOTE:
+                    if self.force_save_presses >= 2:
+                        self.log(f"Note {FORCE_SAVE_NOTE} pressed - saving buffer and showing log window.")
+                        self.save_buffer_to_file(force=True)
+                        append_msg = self.buffer_msgs.append
+                        append_time = self.buffer_times.append
+                        self.root.after(0, self.show_log_window)
+                    else:
+                        self.force_save_presses += 1
+                else:
+                    self.force_save_presses = 0
+            if VERBOSE:
+                try:
+                    self.log("Got " + str(mido.Message.from_bytes(msg)))
+                except ValueError:
+                    self.log("Got unparsed bytes " + msg.hex(' '))
+            if len(self.buffer_msgs) >= MAX_BUFFERED_EVENTS:
+                self.log("Buffer full - saving buffer.")
+                self.save_buffer_to_file(force=True)
+                append_msg = self.buffer_msgs.append
+                append_time = self.buffer_times.append
+
+        if last_input_time is not None:
+            self.last_input_time = last_input_time
+        if pending.dropped:
+            self.log(f"Input queue overflowed - dropped {pending.dropped} messages.")
+            pending.dropped = 0
+
+    def _drain(self):
+        """Process all queued MIDI messages, then reschedule"""
+        # No device I/O happens here, so errors are bugs; Tk reports them
+        try:
+            self._process_pending()
+        finally:
+            # The drain already wakes regularly, so it also notices stop()
+            if self.stop_event.is_set():
+                self.root.quit()
+            else:
+                self.root.after(DRAIN_INTERVAL_MS, self._drain)
+            # Hand lines queued by log() to the open log window.
+            self._flush_log()
+
+    def _check_timeout(self):
+        """Sleep until the no-input deadline and save the buffer once it passes"""
+        idle = time.perf_counter_ns() - self.last_input_time
+        if idle < NO_INPUT_TIMEOUT:
+            # Input arrived since we were scheduled, so the deadline moved
+            self.root.after((NO_INPUT_TIMEOUT - idle) // 1_000_000 + 1, self._check_timeout)
+            return
+
+        self.root.after(NO_INPUT_TIMEOUT // 1_000_000, self._check_timeout)
+        if self.buffer_msgs:
+            self.log("No input timeout reached - saving buffer.")
+            self.save_buffer_to_file()
+
+    def connect(self):
+        """Open the MIDI input, or retry later if no device is available"""
+        retry = self.root.after(RECONNECT_INTERVAL * 1000, self.connect)
+
+        self.refresh_port_names()
+        port_name = self.find_midi_input()
+        if not port_name:
+            if not self.waiting_for_device:
+                self.log("Waiting for MIDI device to connect...")
+                self.waiting_for_device = True
+            return
+
+        if self.waiting_for_device:
+            self.log(f"MIDI device found: {port_name}")
+            self.waiting_for_device = False
+
+        try:
+            self.port = self.open_midi_input(port_name)
+        except (rtmidi.RtMidiError, ValueError) as e:
+            self.log(f"Connection error: {e}")
+            self.log(f"Waiting {RECONNECT_INTERVAL} seconds before reconnecting...")
+            return
+
+        self.root.after_cancel(retry)
+        self.log("Connected! Listening for MIDI input...")
+        self.force_save_presses = 0
+        self.port_misses = 0
+        self.root.after(PORT_CHECK_INTERVAL_MS, self._check_port)
+
+    def _check_port(self):
+        """Reconnect if the device went away, otherwise reschedule"""
+        next_check = self.root.after(PORT_CHECK_INTERVAL_MS, self._check_port)
+
+        self.refresh_port_names()
+        if self.is_port_still_available():
+            if not self.port_misses:
+                return
+            # A device that vanished and came back was re-enumerated, and
+            # the old handle no longer receives anything from it
+            self.log("MIDI device reappeared. Reconnecting...")
+        else:
+            self.port_misses += 1
+            if self.port_misses < PORT_MISSES_BEFORE_DISCONNECT:
+                return
+            self.log("MIDI device disconnected. Attempting to reconnect...")
+
+        self.root.after_cancel(next_check)
+        try:
+            self.port.close_port()
+        except rtmidi.RtMidiError:
+            pass
+        self.port = None
+        self.connect()
 
     def run_with_reconnect(self):
         """Main loop with automatic reconnection handling"""
-        port = None
-        
-        while True:
+        # Everything runs as Tk timers; MIDI arrives through the port
+        # callback, so Tk sleeps until the next drain or check is due
+        self.root.after(0, self.connect)
+        self.root.after(DRAIN_INTERVAL_MS, self._drain)
+        self._check_timeout()
+        self.root.mainloop()
+        self.shutdown()
+
+    def stop(self):
+        """Ask the recorder to finish; safe to call from any thread"""
+        self.stop_event.set()
+
+    def shutdown(self):
+        """Close the port and save whatever has been captured"""
+        if self.shut_down:
+            return
+        self.shut_down = True
+        self.stop_event.set()
+        if self.port is not None:
+            try:
+                self.port.close_port()
+            except rtmidi.RtMidiError:
+                pass
+            self.port = None
+        # Save what was captured even if the last messages can't be processed
+        try:
+            self._process_pending()
+        finally:
             try:
-                # Open or reopen MIDI connection
-                if port is None:
-                    port = self.open_midi_input()
-                    self.log("Connected! Listening for MIDI input...")
-                
-                # Main MIDI processing loop
-                note36 = 0
-                while True:
-                    try:
-                        # Check if port is still available
-                        if not self.is_port_still_available():
-                            self.log("MIDI device disconnected. Attempting to reconnect...")
-                            port.close()
-                            port = None
-                            break
-                        
-                        # Process MIDI messages
-                        for msg in port.iter_pending():
-                            if not msg.is_realtime:
-                                now = time.time()
-                                self.buffer.append((msg, now))
-                                self.last_input_time = now
-                                if msg.type == 'note_on' and msg.velocity > 0:
-                                    self.note_on_count += 1
-                                    if msg.note == 36 and note36 >= 2:
-                                        self.log("Note 36 pressed - saving buffer and showing log window.")
-                                        self.save_buffer_to_file(force=True)
-                                        self.root.after(0, self.show_log_window)
-                                    elif msg.note == 36:
-                                        note36 += 1
-                                    else:
-                                        note36 = 0
-                                self.log(f"Got {msg}")
-
-                        # Check for timeout
-                        if self.buffer and (time.time() - self.last_input_time) > NO_INPUT_TIMEOUT:
-                            self.log("No input timeout reached - saving buffer.")
-                            self.save_buffer_to_file()
-
-                        # Update GUI
-                        self.root.update()
-                        time.sleep(0.01)
-                        
-                    except Exception as e:
-                        self.log(f"Error during MIDI processing: {e}")
-                        if port:
-                            try:
-                                port.close()
-                            except:
-                                pass
-                            port = None
-                        break
-                
-            except Exception as e:
-                self.log(f"Connection error: {e}")
-                if port:
-                    try:
-                        port.close()
-                    except:
-                        pass
-                    port = None
-                
-                # Wait before attempting to reconnect
-                self.log(f"Waiting {RECONNECT_INTERVAL} seconds before reconnecting...")
-                time.sleep(RECONNECT_INTERVAL)
+                self.save_buffer_to_file()
+            finally:
+                self.save_pool.shutdown(wait=True)
 
     def run(self):
         """Legacy run method - now calls the reconnect version"""
@@ -226,8 +480,10 @@ if __name__ == "__main__":
     recorder = None
     try:
         recorder = MidiRecorder()
+        # Let `kill` or a service manager end the recorder with a final save
+        signal.signal(signal.SIGTERM, lambda signum, frame: recorder.stop())
         recorder.run()
     except KeyboardInterrupt:
         if recorder:
-            recorder.save_buffer_to_file()
+            recorder.shutdown()
         print("Stopped by user.")